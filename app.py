@@ -22,22 +22,26 @@ Pre-flight:
 from __future__ import annotations
 
 import os
-import json
+import re
+import time
+import asyncio
+import hashlib
 import logging
+import secrets
+import orjson
 import gradio as gr
-from uuid import uuid4
-from typing import Generator, Any
+from types import MappingProxyType
+from typing import AsyncGenerator, Any
 
 from pathlib import Path
 
 
 from utils import (
     PromptTemplate,
-    convert_gradio_to_openai,
     initialize_client,
     load_dotenv,
     upload_azure,
-    record_chat,
+    enqueue_chat,
     ChatLoggerHandler
 )
 
@@ -48,7 +52,19 @@ chat_logger = ChatLoggerHandler()
 if os.environ.get("AZURE_ENDPOINT") is None:  # Set Azure credentials from local files
     load_dotenv()
 client = initialize_client()  # Shared across sessions
-question_mapping: dict[str, str] = json.loads(Path("assets/question_mapping.json").read_text())
+question_mapping: dict[str, str] = orjson.loads(Path("assets/question_mapping.json").read_bytes())
+QUESTIONS: dict[str, dict] = {
+    k: orjson.loads(Path(f"./assets/questions/{v}").read_bytes())
+    for k, v in question_mapping.items()
+}
+INITIAL_TMPL: PromptTemplate = PromptTemplate.from_file("assets/initial_message.txt")
+SYSTEM_TMPL: PromptTemplate = PromptTemplate.from_file("assets/system_message.txt")
+MODEL_ARGS: MappingProxyType = MappingProxyType({"model": "gpt-4o-default", "temperature": 0.0})
+FLUSH_MS: int = 25  # Max delay before buffered deltas are pushed to the chat display
+FLUSH_CHARS: int = 64  # Max buffered characters before pushing to the chat display
+RESPONSE_CACHE: dict[str, str] = {}  # Exact-match cache of completed replies, by request hash
+RESPONSE_CACHE_SIZE: int = 1024  # Oldest entries are evicted beyond this
+END_TOKEN_RE: re.Pattern[str] = re.compile(re.escape("<end_of_survey>"))  # Compiled once
 
 
 # %% (functions)
@@ -75,15 +91,15 @@ def initialize_interview(request: gr.Request) -> tuple:
     # Parse question
     question_id: str = request_params.get("questionid", "0")
     response_id: str = request_params.get("response", "0")
-    question_data: dict = json.loads(Path(f"./assets/questions/{question_mapping[question_id]}").read_text())
+    question_data: dict = QUESTIONS[question_id]
     question_wording: str = question_data["question"]
     question_choices: str = question_data["choices"]
     response_text: str = question_choices[int(response_id)]
     base_logger.info(f"Question: {question_wording} ({response_text})")
 
     # Load initial and system messages
-    initial_message: str = PromptTemplate.from_file("assets/initial_message.txt").format(surveyQuestion=question_wording)
-    system_message: str = PromptTemplate.from_file("assets/system_message.txt").format(surveyQuestion=question_wording, responseVal=response_text)
+    initial_message: str = INITIAL_TMPL.format(surveyQuestion=question_wording)
+    system_message: str = SYSTEM_TMPL.format(surveyQuestion=question_wording, responseVal=response_text)
     base_logger.info(f"Initial message: {initial_message}")
     base_logger.info(f"System message: {system_message}")
 
@@ -106,6 +122,8 @@ def initialize_interface(initial_message: str) -> tuple:
         chat_input: update placeholder, make interactive
         chat_submit: make interactive
         start_button: hide
+        messages: seed openai-format history with initial_message
+        history_digest: seed running digest of that history
     """
     instruction_text = gr.Markdown("")
     chat_display = gr.Chatbot(
@@ -129,12 +147,22 @@ def initialize_interface(initial_message: str) -> tuple:
         visible=True,
     )
     start_button = gr.Button("Start Interview", visible=False, variant="primary")
-    return (instruction_text, chat_display, chat_input, chat_submit, start_button)
+    messages = [{"role": "assistant", "content": initial_message}]
+    history_digest = sync_history_digest((0, ""), messages)
+    return (
+        instruction_text,
+        chat_display,
+        chat_input,
+        chat_submit,
+        start_button,
+        messages,
+        history_digest,
+    )
 
 
 # Interaction
 # - User message
-# - Bot message
+# - Bot message (with response cache)
 # - Check if interview finished
 # - Record interaction (local log)
 
@@ -146,60 +174,167 @@ def user_message(
     return "", chat_history + [[message, None]]
 
 
-def bot_message(
+def extend_history_digest(history_digest: str, message: dict[str, str]) -> str:
+    "Chains one appended message into the running digest of the openai-format history."
+    payload = orjson.dumps(message, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(history_digest.encode("ascii") + payload).hexdigest()
+
+
+def sync_history_digest(
+    history_digest: tuple[int, str], messages_state: list[dict[str, str]]
+) -> tuple[int, str]:
+    """
+    Extends the (message count, digest) pair over messages appended since its last update.
+    Catches up after a turn whose outputs Gradio never stored (e.g. a failed request).
+    """
+    n_digested, digest = history_digest
+    if n_digested > len(messages_state):  # History was shortened (interview_end_check): rebuild
+        n_digested, digest = 0, ""
+    for message in messages_state[n_digested:]:
+        digest = extend_history_digest(digest, message)
+    return len(messages_state), digest
+
+
+def response_cache_key(
+    history_digest: str, system_message: str, user_msg: str, model_args: dict
+) -> str:
+    """
+    Hashes the full request, so only identical system/history/user turns share a reply.
+    History enters via its running digest, so the cost does not grow with turn count.
+    """
+    payload = orjson.dumps([model_args, system_message, user_msg], option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(history_digest.encode("ascii") + payload).hexdigest()
+
+
+def cache_response(key: str, reply: str) -> None:
+    if len(RESPONSE_CACHE) >= RESPONSE_CACHE_SIZE:
+        del RESPONSE_CACHE[next(iter(RESPONSE_CACHE))]
+    RESPONSE_CACHE[key] = reply
+
+
+async def stream_reply(
+    messages: list[dict[str, str]],
+    session_id: str,
+    model_args: dict,
+    cached: str | None,
+) -> AsyncGenerator[str, Any]:
+    "Yields reply text in batches: replayed from `cached` if given, else streamed from the API."
+    if cached is not None:
+        # Replay cached reply at the batched streaming cadence
+        for i in range(0, len(cached), FLUSH_CHARS):
+            if i:
+                await asyncio.sleep(FLUSH_MS / 1000)
+            yield cached[i : i + FLUSH_CHARS]
+        return
+    # API call (`user` keeps a session's requests routed to the same cache)
+    response = await client.chat.completions.create(
+        messages=messages,
+        stream=True,
+        user=session_id,
+        model=model_args["model"],
+        temperature=model_args["temperature"],
+    )
+    # Streaming (batched, so each yield carries several deltas)
+    buf: list[str] = []
+    buf_chars = 0
+    last_flush = time.monotonic()
+    async for chunk in response:
+        delta = chunk.choices[0].delta.content
+        if delta:
+            buf.append(delta)
+            buf_chars += len(delta)
+            now = time.monotonic()
+            if buf_chars >= FLUSH_CHARS or (now - last_flush) > FLUSH_MS / 1000:
+                yield "".join(buf)
+                buf.clear()
+                buf_chars = 0
+                last_flush = now
+    if buf:
+        yield "".join(buf)
+
+
+async def bot_message(
     chat_history: list[list[str | None]],
+    messages_state: list[dict[str, str]],
+    history_digest: tuple[int, str],
     system_message: str,
-    model_args: dict = {"model": "gpt-4o-default", "temperature": 0.0},
-) -> Generator[Any, Any, Any]:
-    "Streams response from OpenAI API to chat interface."
+    session_id: str,
+    model_args: dict,
+) -> AsyncGenerator[Any, Any]:
+    """
+    Streams response from OpenAI API to chat interface.
+    `messages_state` is the append-only openai-format history. The user message is
+    added before the API call and the reply (even a partial one) when streaming stops,
+    so a failed request never drops the turn from the context or the transcript.
+    Identical requests are replayed from `RESPONSE_CACHE` in FLUSH_CHARS chunks.
+    """
     # Prep messages
+    # Canonical order [system, *history, user] keeps the request prefix
+    # byte-identical across turns, so the API's prompt cache can reuse it.
+    history_digest = sync_history_digest(history_digest, messages_state)
     user_msg = chat_history[-1][0]
-    messages = convert_gradio_to_openai(chat_history[:-1])
     messages = (
         [{"role": "system", "content": system_message}]
-        + messages
+        + messages_state
         + [{"role": "user", "content": user_msg}]
     )
-    # API call
-    response = client.chat.completions.create(
-        messages=messages, stream=True, **model_args
-    )
-    # Streaming
+    key = response_cache_key(history_digest[1], system_message, user_msg, model_args)
+    cached = RESPONSE_CACHE.get(key)
+    # Extend history with this turn (empty messages are skipped, as in convert_gradio_to_openai)
+    if user_msg:
+        messages_state.append({"role": "user", "content": user_msg})
     chat_history[-1][1] = ""
-    for chunk in response:
-        delta = chunk.choices[0].delta.content
-        if delta:
-            chat_history[-1][1] += delta
-            yield chat_history
-
-
-def log_interaction(
+    completed = False
+    try:
+        async for text in stream_reply(messages, session_id, model_args, cached):
+            chat_history[-1][1] += text
+            yield chat_history, messages_state, history_digest
+        completed = True
+    finally:
+        # Keep messagesState in step with the display on every exit path
+        if chat_history[-1][1]:
+            messages_state.append({"role": "assistant", "content": chat_history[-1][1]})
+    if completed and cached is None and chat_history[-1][1]:
+        cache_response(key, chat_history[-1][1])
+    history_digest = sync_history_digest(history_digest, messages_state)
+    yield chat_history, messages_state, history_digest
+
+
+async def log_interaction(
     chat_history: list[list[str | None]],
     session_id: str,
 ) -> None:
-    "Record last pair of interactions"
-    record_chat(chat_logger, session_id, "user", chat_history[-1][0])
-    record_chat(chat_logger, session_id, "bot", chat_history[-1][1])
+    "Record last pair of interactions (written in the background)"
+    enqueue_chat(chat_logger, session_id, "user", chat_history[-1][0])
+    enqueue_chat(chat_logger, session_id, "bot", chat_history[-1][1])
 
 
 def interview_end_check(
     chat_history: list[list[str | None]],
+    messages_state: list[dict[str, str]],
     limit: int = 20,
-    end_of_interview: str = "<end_of_survey>",
-) -> tuple[list[list[str | None]], gr.Button, gr.Textbox, gr.Button]:
+    end_of_interview: re.Pattern[str] = END_TOKEN_RE,
+) -> tuple[list[list[str | None]], list[dict[str, str]], gr.Button, gr.Textbox, gr.Button]:
     """
     Checks if interview has completed using two conditions:
-    1. If the last bot message contains `end_of_interview` (default: "<end_of_survey>". Replaced "<end_interview>" with this new default token by Kentaro)
+    1. If the last bot message matches `end_of_interview` (default: END_TOKEN_RE for "<end_of_survey>". Replaced "<end_interview>" with this new default token by Kentaro)
     2. Conversation length has reached `limit` (default: 10)
 
     If either condition is met, the end of interview button is displayed.
+    The stripped bot message is mirrored into `messages_state`, so it matches the display.
     """
     flag = False
     if len(chat_history) >= limit:
         flag = True
-    if end_of_interview in chat_history[-1][1]:
-        chat_history[-1][1] = chat_history[-1][1].replace(end_of_interview, "")
+    # Single pass: strips the token and reports whether it was present
+    chat_history[-1][1], n_found = end_of_interview.subn("", chat_history[-1][1])
+    if n_found:
         flag = True
+        if messages_state and messages_state[-1]["role"] == "assistant":
+            if chat_history[-1][1]:
+                messages_state[-1]["content"] = chat_history[-1][1]
+            else:
+                messages_state.pop()
     input_button = gr.Textbox(
         placeholder="Type response here. Hit `Enter` or click the arrow to submit.",
         visible= not flag,
@@ -215,7 +350,7 @@ def interview_end_check(
         visible= not flag,
     )
     button = gr.Button("Save and Exit", visible=flag, variant="stop")
-    return chat_history, button, input_button, submit_button
+    return chat_history, messages_state, button, input_button, submit_button
 
 
 # Completion
@@ -225,20 +360,21 @@ def interview_end_check(
 
 
 def generate_completion_code(prefix: str = "cd-") -> str:
-    return prefix + str(uuid4())
+    return prefix + secrets.token_urlsafe(16)
 
 
-def upload_interview(
+async def upload_interview(
     session_id: str,
-    chat_history: list[list[str | None]],
+    messages_state: list[dict[str, str]],
 ) -> None:
-    "Upload chat history to Azure blob storage"
-    upload_azure(session_id, chat_history)
+    "Upload chat history (openai format) to Azure blob storage"
+    await upload_azure(session_id, messages_state)
 
 
-def end_interview(
+async def end_interview(
     session_id: str,
     chat_history: list[list[str | None]],
+    messages_state: list[dict[str, str]],
 ) -> tuple[list[list[str | None]], gr.Text]:
     """Create completion code and display in chat interface."""
     completion_message = (
@@ -248,7 +384,8 @@ def end_interview(
         "and paste this code into the  completion "
         "code box.".format(generate_completion_code())
     )
-    upload_interview(session_id, chat_history)
+    await upload_interview(session_id, messages_state)
+    await chat_logger.aclose(session_id)
     EndMessage = gr.Text(completion_message, visible=True, show_label=False, scale=10)
     return chat_history, EndMessage
 
@@ -269,7 +406,9 @@ with gr.Blocks(theme="sudeepshouche/minimalist") as demo:
     questionWording = gr.State()
     initialMessage = gr.State()
     systemMessage = gr.State()
-    modelArgs = gr.State(value={"model": "gpt-4o-default", "temperature": 0.0})
+    modelArgs = gr.State(value=dict(MODEL_ARGS))  # gr.State deep-copies, so pass a plain dict
+    messagesState = gr.State(value=[])  # openai-format history, appended each turn
+    historyDigest = gr.State(value=(0, ""))  # (messages digested, digest) of messagesState, for the response cache
 
     # Chat app (display, input, submit button)
     startButton = gr.Button("Start Interview", visible=True, variant="primary")
@@ -338,7 +477,10 @@ with gr.Blocks(theme="sudeepshouche/minimalist") as demo:
             chatInput,
             chatSubmit,
             startButton,
+            messagesState,
+            historyDigest,
         ],
+        queue=False,
     )
     # Chat interaction
     # "Enter"
@@ -349,13 +491,19 @@ with gr.Blocks(theme="sudeepshouche/minimalist") as demo:
         queue=False,
     ).then(
         bot_message,
-        inputs=[chatDisplay, systemMessage, modelArgs],
-        outputs=[chatDisplay],
+        inputs=[chatDisplay, messagesState, historyDigest, systemMessage, sessionId, modelArgs],
+        outputs=[chatDisplay, messagesState, historyDigest],
+        concurrency_limit=8,  # Only the LLM call is throttled; the id shares the limit
+        concurrency_id="bot_message",  # across the submit and click events
     ).then(
         log_interaction,
         inputs=[chatDisplay, sessionId],
+        queue=False,
     ).then(
-        interview_end_check, inputs=[chatDisplay], outputs=[chatDisplay, exitButton, chatInput, chatSubmit]
+        interview_end_check,
+        inputs=[chatDisplay, messagesState],
+        outputs=[chatDisplay, messagesState, exitButton, chatInput, chatSubmit],
+        queue=False,
     )
 
     # Button
@@ -366,23 +514,31 @@ with gr.Blocks(theme="sudeepshouche/minimalist") as demo:
         queue=False,
     ).then(
         bot_message,
-        inputs=[chatDisplay, systemMessage, modelArgs],
-        outputs=[chatDisplay],
+        inputs=[chatDisplay, messagesState, historyDigest, systemMessage, sessionId, modelArgs],
+        outputs=[chatDisplay, messagesState, historyDigest],
+        concurrency_limit=8,  # Only the LLM call is throttled; the id shares the limit
+        concurrency_id="bot_message",  # across the submit and click events
     ).then(
         log_interaction,
         inputs=[chatDisplay, sessionId],
+        queue=False,
     ).then(
-        interview_end_check, inputs=[chatDisplay], outputs=[chatDisplay, exitButton, chatInput, chatSubmit]
+        interview_end_check,
+        inputs=[chatDisplay, messagesState],
+        outputs=[chatDisplay, messagesState, exitButton, chatInput, chatSubmit],
+        queue=False,
     )
 
     # Reset button
     exitButton.click(
-        end_interview, inputs=[sessionId, chatDisplay], outputs=[chatDisplay, EndMessage]
+        end_interview, inputs=[sessionId, chatDisplay, messagesState], outputs=[chatDisplay, EndMessage]
     )
     # testExitButton.click(
     #     end_interview, inputs=[sessionId, chatDisplay], outputs=[chatDisplay]
     # )
 
+demo.queue(default_concurrency_limit=16, max_size=64)
+
 
 if __name__ == "__main__":
     demo.launch()#auth=auth_no_user)
@@ -1,39 +1,102 @@
 from __future__ import annotations
 
+import asyncio
 import datetime
-import json
+import functools
+import logging
 import os
+import threading
+from collections import OrderedDict
 from configparser import ConfigParser
 from pathlib import Path
 from string import Formatter
+from typing import BinaryIO, ClassVar
 from dotenv import dotenv_values
 
+import orjson
+
 import openai
-from azure.storage.blob import BlobClient
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
 
+logger = logging.getLogger(__name__)
 
 # Logging util
-def get_current_timestamp() -> str:
-    return datetime.datetime.now().isoformat()
-
-
 class ChatLoggerHandler:
     """Shared logging handler for chat logs. Runs common to all Gradio sessions."""
 
-    def __init__(self, logdir: str = "./logs") -> None:
+    def __init__(self, logdir: str = "./logs", max_open_handles: int = 128) -> None:
         self.logdir: Path = Path(logdir)
         if not self.logdir.exists():
             self.logdir.mkdir()
-
-    def record(self, session: str, role: str, record: str):
+        # Open log file per session (flushed after each entry), least recently used first. Capped so
+        # sessions abandoned before end_interview cannot exhaust file descriptors.
+        self._handles: OrderedDict[str, BinaryIO] = OrderedDict()
+        self._handles_lock = threading.Lock()
+        self.max_open_handles: int = max_open_handles
+        self._queue: asyncio.Queue | None = None  # Pending entries for the background writer
+        self._writer: asyncio.Task | None = None
+
+    def _get_handle(self, session: str) -> BinaryIO:
+        "Returns the session's open log file, closing the least recently used one if at the cap."
+        handle = self._handles.get(session)
+        if handle is not None:
+            self._handles.move_to_end(session)
+            return handle
+        if len(self._handles) >= self.max_open_handles:
+            _, oldest = self._handles.popitem(last=False)
+            oldest.close()  # Reopened in append mode if that session writes again
+        handle = open(self.logdir / f"{session}.jsonl", "ab")
+        self._handles[session] = handle
+        return handle
+
+    def record(
+        self, session: str, role: str, record: str, timestamp: datetime.datetime | None = None
+    ):
         log_entry = {
             "session": session,
-            "timestamp": get_current_timestamp(),
+            "timestamp": timestamp or datetime.datetime.now(),  # orjson writes isoformat
             "role": role,
             "message": record,
         }
-        with open(self.logdir / f"{session}.jsonl", "a+") as f:
-            f.write(json.dumps(log_entry) + "\n")
+        with self._handles_lock:
+            handle = self._get_handle(session)
+            # Buffered writer retries short writes; flush keeps it to one syscall per entry
+            handle.write(orjson.dumps(log_entry) + b"\n")
+            handle.flush()
+
+    def close(self, session: str) -> None:
+        "Closes the log file for a finished session."
+        with self._handles_lock:
+            handle = self._handles.pop(session, None)
+            if handle is not None:
+                handle.close()
+
+    def enqueue(self, session: str, role: str, record: str) -> None:
+        """
+        Queues an entry for the background writer and returns immediately.
+        Must be called from the event loop; the writer task is started on first use.
+        """
+        if self._writer is None:
+            self._queue = asyncio.Queue()
+            self._writer = asyncio.create_task(self._drain())
+        self._queue.put_nowait((session, role, record, datetime.datetime.now()))
+
+    async def _drain(self) -> None:
+        "Writes queued entries in order, off the event loop."
+        while True:
+            entry = await self._queue.get()
+            try:
+                await asyncio.to_thread(self.record, *entry)
+            except Exception:
+                logger.exception(f"Failed to write chat log entry for session {entry[0]}")
+            finally:
+                self._queue.task_done()
+
+    async def aclose(self, session: str) -> None:
+        "Flushes queued entries, then closes the log file for a finished session."
+        if self._queue is not None:
+            await self._queue.join()
+        await asyncio.to_thread(self.close, session)
 
 
 def record_chat(
@@ -42,13 +105,27 @@ def record_chat(
     logger.record(session, role, record)
 
 
+def enqueue_chat(
+    logger: ChatLoggerHandler, session: str, role: str, record: str
+) -> None:
+    logger.enqueue(session, role, record)
+
+
 # General Class
 class PromptTemplate(str):
     """More robust String Formatter. Takes a string and parses out the keywords."""
 
+    __slots__ = ("template", "variables", "_var_set", "_fmt")  # No per-instance __dict__
+    _CACHE: ClassVar[dict[str, list[str]]] = {}  # Parsed variables by template string
+
     def __init__(self, template: str) -> None:
         self.template: str = template
-        self.variables: list[str] = self.parse_template()
+        variables = PromptTemplate._CACHE.get(template)
+        if variables is None:
+            variables = PromptTemplate._CACHE.setdefault(template, self.parse_template())
+        self.variables: list[str] = variables
+        self._var_set: frozenset[str] = frozenset(self.variables)
+        self._fmt = self.template.format_map
 
     def parse_template(self) -> list[str]:
         "Returns template variables"
@@ -66,8 +143,17 @@ class PromptTemplate(str):
         :return: Formatted string.
         :raises: ValueError if arguments do not match template variables.
         """
+        # Fast path: keyword arguments only, checked against precomputed variables
+        if kwargs and not args:
+            if kwargs.keys() != self._var_set:
+                raise ValueError("Keyword arguments do not match template variables.")
+            try:
+                return self._fmt(kwargs)
+            except KeyError as e:
+                raise ValueError(f"Missing a keyword argument: {e}")
+
         # If keyword arguments are provided, check if they match the template variables
-        if kwargs and set(kwargs) != set(self.variables):
+        if kwargs and kwargs.keys() != self._var_set:
             raise ValueError("Keyword arguments do not match template variables.")
 
         # If positional arguments are provided, check if their count matches the number of template variables
@@ -79,7 +165,7 @@ class PromptTemplate(str):
         # Check if a dictionary is passed as a single positional argument
         if len(args) == 1 and isinstance(args[0], dict):
             arg_dict = args[0]
-            if set(arg_dict) != set(self.variables):
+            if arg_dict.keys() != self._var_set:
                 raise ValueError("Dictionary keys do not match template variables.")
             return self.template.format(**arg_dict)
 
@@ -95,9 +181,8 @@ class PromptTemplate(str):
 
     @classmethod
     def from_file(cls, file_path: str) -> PromptTemplate:
-        with open(file_path, encoding="utf-8") as file:
-            template_content = file.read()
-        return cls(template_content)
+        "Loads template from file. Cached by path and mtime, so edits are picked up."
+        return _read_template(cls, str(file_path), os.stat(file_path).st_mtime_ns)
 
     def dump_prompt(self, file_path: str) -> None:
         with open(file_path, "w", encoding="utf-8") as file:
@@ -105,16 +190,24 @@ class PromptTemplate(str):
             file.close()
 
 
+@functools.lru_cache(maxsize=64)
+def _read_template(cls: type[PromptTemplate], file_path: str, mtime_ns: int) -> PromptTemplate:
+    "Reads and parses template file. `mtime_ns` is only part of the cache key."
+    with open(file_path, encoding="utf-8") as file:
+        template_content = file.read()
+    return cls(template_content)
+
+
 def convert_gradio_to_openai(
     chat_history: list[list[str | None]],
 ) -> list[dict[str, str]]:
     "Converts gradio chat format -> openai chat request format"
-    messages = []
-    for pair in chat_history:  # [(user), (assistant)]
-        for i, role in enumerate(["user", "assistant"]):
-            if not ((pair[i] is None) or (pair[i] == "")):
-                messages += [{"role": role, "content": pair[i]}]
-    return messages
+    return [
+        {"role": role, "content": content}
+        for pair in chat_history  # [(user), (assistant)]
+        for role, content in zip(("user", "assistant"), pair)
+        if content  # Skips None and ""
+    ]
 
 
 def convert_openai_to_gradio(
@@ -129,10 +222,12 @@ def convert_openai_to_gradio(
     return chat_history
 
 
+@functools.cache
 def load_dotenv():
+    "Seeds os.environ from .env once per process. Existing values are kept."
     config = dotenv_values(".env")
     for key, value in config.items():
-        os.environ[key] = value
+        os.environ.setdefault(key, value)
 
 
 def seed_azure_key(cfg: str = "~/.cfg/openai.cfg") -> None:
@@ -145,8 +240,9 @@ def seed_azure_key(cfg: str = "~/.cfg/openai.cfg") -> None:
     os.environ["AZURE_SECRET"] = config["AZURE"]["key"]
 
 
+@functools.cache
 def initialize_client() -> openai.AsyncClient:
-    client = openai.AzureOpenAI(
+    client = openai.AsyncAzureOpenAI(
         azure_endpoint=os.environ["AZURE_ENDPOINT"],
         api_key=os.environ["AZURE_SECRET"],
         api_version="2023-05-15",
@@ -161,14 +257,21 @@ def auth_no_user(username, password):
         return False
 
 
-def upload_azure(conversation_id: str, chat_history) -> None:
+@functools.cache
+def get_container_client() -> ContainerClient:
+    "Shared async container client. Blob clients made from it reuse its connection pool."
+    service_client = BlobServiceClient.from_connection_string(os.getenv("AZURE_CONN_STR"))
+    return service_client.get_container_client(os.getenv("AZURE_CONTAINER_NAME"))
+
+
+async def upload_azure(conversation_id: str, records: list[dict[str, str]]) -> None:
+    "Uploads openai-format chat records as json lines."
     # Get blob client
-    conn_str = os.getenv("AZURE_CONN_STR")
-    container_name = os.getenv("AZURE_CONTAINER_NAME")
     blob_name = conversation_id
-    blob_client = BlobClient.from_connection_string(conn_str, container_name, blob_name)
+    blob_client = get_container_client().get_blob_client(blob_name)
 
-    # Convert chat_history to json lines
-    records = convert_gradio_to_openai(chat_history)
-    records_text = "\n".join([json.dumps(record) for record in records])
-    blob_client.upload_blob(records_text, blob_type="AppendBlob", overwrite=True)
+    # Records -> json lines, streamed to the SDK without building the full text
+    records_lines = (orjson.dumps(record) + b"\n" for record in records)
+    await blob_client.upload_blob(
+        records_lines, length=None, blob_type="AppendBlob", overwrite=True
+    )